@@ -19,11 +19,10 @@ for B in cdparanoia flac metaflac ; do
   type -a $B
 done
 
-msg 'Ripping audio stream'
-cdparanoia "1-"
-
-msg 'Compressing audio stream'
-flac -o "$OUTFILE" --delete-input-file -V --padding 262144 cdda.wav
+# Piping cdparanoia into flac compresses while the drive is still
+# reading, and never writes the ~700MB intermediate wav to disk at all.
+msg 'Ripping and compressing audio stream'
+cdparanoia "1-" - | flac -o "$OUTFILE" -V --padding 262144 -
 
 msg 'Creating cuesheet'
 TRACKS=$(cdparanoia -Q 2>&1 | awk '/^ *[0-9]+\. / { print $5; }' | tr -d '[]' | tr '.' ':')
@@ -35,7 +34,7 @@ I=1
     printf '    INDEX 01 %s\n' $T
     I=$(($I + 1))
   done
-) | metaflac --import-cuesheet-from=- "$OUTFILE"
+) > cuesheet
 
 msg 'Creating tags'
 I=1
@@ -50,7 +49,10 @@ I=1
 ) > tags
 
 $EDITOR tags
-metaflac --import-tags-from=tags "$OUTFILE"
+
+# metaflac rewrites the whole (disc-sized) file per invocation, so do
+# the cuesheet and tag imports in one pass.
+metaflac --import-cuesheet-from=cuesheet --import-tags-from=tags "$OUTFILE"
 
 ARTIST=$(grep 'ARTIST=' tags | cut -d= -f2)
 ALBUM=$(grep 'ALBUM=' tags | cut -d= -f2)
@@ -60,6 +62,8 @@ if [ -n "$ARTIST" -a -n "$ALBUM" ] ; then
   msg "Finished file is '$NEWFILE'"
 fi
 
+rm cuesheet tags
+
 msg "Remember to store the cover image:"
 msg "metaflac --import-picture-from=xyz.jpg '$NEWFILE'"
 
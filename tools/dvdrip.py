@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """dvdrip.py - Dump video titles from DVD to multiplexed MP4 files.
 
 No conversion or re-coding is done, yet this still gets very
@@ -28,12 +28,15 @@ sometimes.
 Written 2018 by Mikey Dickerson.
 """
 
-from __future__ import print_function
-
 import argparse
+import collections
+import concurrent.futures
+import heapq
+import io
 import os
 import random
 import re
+import string
 import subprocess
 import sys
 
@@ -49,6 +52,23 @@ If you should need to look up some more:
 https://en.wikipedia.org/wiki/List_of_ISO_639-2_codes
 """
 
+# All the patterns we ever look for in lsdvd/mplayer/ffmpeg output,
+# compiled once here rather than inside the loops that run them against
+# every line of a feature-length log.
+TITLE_RE = re.compile(r'Title: (\d+), Length: ([0-9:\.]+)')
+# The audio and subtitle announcements are fused into one alternation
+# so that each line of mplayer output is scanned once, not twice.  It
+# is a bytes pattern because mplayer stdout is not reliably text -- the
+# decoder leaks raw binary into the log -- so we match the raw lines
+# and only decode the few characters we capture.
+STREAM_DEF_RE = re.compile(
+  rb'(?:audio stream: \d+ format: (?P<fmt1>[\w\.]+) \((?P<fmt2>[\w\.]+)\) '
+  rb'language: (?P<alang>\w+))'
+  rb'|(?:subtitle \( sid \): \d+ language: (?P<slang>\w+))')
+CODEC_ERR_RE = re.compile(r'Could not find codec parameters for stream (\d+)')
+STREAM_RE = re.compile(r'Stream #0:(\d+)')
+
+
 lang_iso_code = {
   'ar': 'ara', # Arabic
   'cy': 'cym', # Welsh
@@ -65,9 +85,12 @@ lang_iso_code = {
   'th': 'tha', # Thai
   'ru': 'rus', # Russian
   'zh': 'chi', # Chinese
-  'unknown': 'eng',
 }
 
+# Interned keys make the lookup in iso_lang a pointer compare in the
+# common case.
+lang_iso_code = dict((sys.intern(k), v) for k, v in lang_iso_code.items())
+
 
 class Stream(object):
   """Stream here is a container for metadata describing one of the streams
@@ -82,6 +105,18 @@ class Stream(object):
     return ' '.join(map(str, [self.type, self.format or '', self.language]))
 
 
+def iso_lang(code):
+  """Map the 2-letter code mplayer reports to the 3-letter code ffmpeg
+  accepts.  DVDs report plenty of languages that aren't in the table
+  ('it', 'nl', 'sv', 'unknown', ...); tag those 'eng' and carry on
+  rather than blowing up the rip."""
+  lang = lang_iso_code.get(code)
+  if lang is None:
+    msg("Don't know language '%s', tagging it 'eng'" % code)
+    lang = 'eng'
+  return lang
+
+
 def msg(s, stream=sys.stdout):
   """Write s to stdout with ANSI color control codes."""
   stream.write(''.join(['\033[92m', s, '\033[0m', '\n']))
@@ -93,33 +128,40 @@ def die(err):
   sys.exit(1)
 
 
+def length_to_seconds(s):
+  """Convert an lsdvd 'H:MM:SS.fff' length string to float seconds."""
+  secs = 0.0
+  for part in s.split(':'):
+    secs = secs * 60 + float(part)
+  return secs
+
+
 def read_toc(n):
   """Use lsdvd to read the table of contents, print each 'Title' line,
   and find the n longest titles."""
   title_len = []
-  for line in subprocess.Popen('lsdvd', stdout=subprocess.PIPE).stdout:
-    line = line.strip().decode('utf-8')
+  p = subprocess.Popen(['lsdvd'], stdout=subprocess.PIPE, bufsize=1<<20)
+  for line in io.TextIOWrapper(p.stdout, encoding='utf-8', errors='replace'):
+    line = line.strip()
     print(line)
-    m = re.match('Title: (\d+), Length: ([0-9:\.]+)', line)
-    if m: title_len.append((m.group(2), int(m.group(1))))
+    if not line.startswith('Title:'): continue
+    m = TITLE_RE.match(line)
+    if m: title_len.append((length_to_seconds(m.group(2)), int(m.group(1))))
+  p.wait()
 
   # Guess at which dvd titles you meant to rip.  We pick the N longest
   # ones on the disc, but we put them back in the order they appeared.
-  title_len.sort(key=lambda x: x[0], reverse=True)
-  title_len = title_len[:n]
-  title_len.sort(key=lambda x: x[1])
-  return [ x[1] for x in title_len ]
+  # Comparing as seconds matters: as strings, '9:00:00' > '10:00:00'.
+  longest = heapq.nlargest(n, title_len, key=lambda x: x[0])
+  longest.sort(key=lambda x: x[1])
+  return [ x[1] for x in longest ]
 
 
 def mktemp():
   """Real mktemp type functions are a problem here because the temp file
   isn't likely to fit in /tmp.  It is a much better assumption that it
   fits in cwd.  So this will have to do."""
-  path = ['dvdrip.' ]
-  for i in range(6):
-    path.append(random.choice('abcdefghijklmnopqrstuvwxyz'))
-  path.append('.vob')
-  return ''.join(path)
+  return 'dvdrip.%s.vob' % ''.join(random.choices(string.ascii_lowercase, k=6))
 
 
 def parse_metadata(log):
@@ -127,23 +169,22 @@ def parse_metadata(log):
   identifying the format and language of the streams in the
   multiplexed dump."""
   streams = []
-  audio_re = re.compile(r'audio stream: \d+ format: ([\w\.]+) \(([\w\.]+)\) '
-                        'language: (\w+)')
-  subtitle_re = re.compile(r'subtitle \( sid \): \d+ language: (\w+)')
-
+  # Bind the one lookup made on every line to a local; LOAD_FAST beats
+  # LOAD_GLOBAL plus an attribute fetch in a loop this hot.
+  search = STREAM_DEF_RE.search
   for line in log:
-    line = line.strip().decode('utf-8')
-    m = audio_re.match(line)
-    if m:
-      stream = Stream('audio', '%s:%s' % (m.group(1), m.group(2)),
-                      lang_iso_code[m.group(3)])
-      msg('Spotted stream: %s' % stream)
-      streams.append(stream)
-    m = subtitle_re.match(line)
-    if m:
-      stream = Stream('subtitle', None, lang_iso_code[m.group(1)])
-      msg('Spotted stream: %s' % stream)
-      streams.append(stream)
+    m = search(line)
+    if not m: continue
+    if m.group('alang'):
+      stream = Stream('audio',
+                      '%s:%s' % (m.group('fmt1').decode('ascii'),
+                                 m.group('fmt2').decode('ascii')),
+                      iso_lang(m.group('alang').decode('ascii')))
+    else:
+      stream = Stream('subtitle', None,
+                      iso_lang(m.group('slang').decode('ascii')))
+    msg('Spotted stream: %s' % stream)
+    streams.append(stream)
 
   return streams
 
@@ -153,10 +194,15 @@ def rip(t, dumpfile):
   output and send to parse_metadata to find the stream descriptors."""
   msg('Ripping title %d' % t)
   cmd = [ 'mplayer', '-dumpstream', 'dvd://%d' % t,
-          '-nocache', '-noidx', '-dumpfile', tmp ]
+          '-nocache', '-noidx', '-dumpfile', dumpfile ]
   msg('Running: %s' % ' '.join(cmd))
-  log = subprocess.Popen(cmd, stdout=subprocess.PIPE).stdout
-  return parse_metadata(log)
+  # mplayer logorrhea runs to hundreds of thousands of lines; a big pipe
+  # buffer turns the one-read()-per-line pattern into one per megabyte.
+  # The pipe stays in bytes; parse_metadata matches the raw lines.
+  p = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1<<20)
+  streams = parse_metadata(p.stdout)
+  p.wait()
+  return streams
 
 
 def stream_language_tags(stream_defs):
@@ -178,19 +224,20 @@ def stream_language_tags(stream_defs):
   return args
 
 
+# Character disposition for filesafe(), built once: shell-hostile
+# characters are deleted, path-separator-ish ones become '-'.
+_FILESAFE_TABLE = str.maketrans({c: None for c in '?*"\\\'!<>()'})
+_FILESAFE_TABLE.update(str.maketrans(':/#', '---'))
+
+
 def filesafe(s):
   """Deletes or substitutes the characters that are likely to cause
   non-portable filenames: anything Unicode, and (?*:/\#!"'<>)."""
   if not s: return ''
-  s = s.encode('ascii', 'replace').decode('ascii')
-  badchar = r'?*"\'!<>()'
-  for c in badchar: s = s.replace(c, '')
-  badchar = r':/\#'
-  for c in badchar: s = s.replace(c, '-')
-  return s
+  return s.encode('ascii', 'replace').decode('ascii').translate(_FILESAFE_TABLE)
 
 
-def re_mux(tmpfile, metadata_bag):
+def re_mux(tmpfile, metadata_bag, streams):
   """You have to re-multiplex the entire file to get metadata tags into
   it.  The bare minimum way to do this is to pass all the streams
   through the ffmpeg 'copy' codec.  Unfortunately this exposes us to
@@ -203,6 +250,12 @@ def re_mux(tmpfile, metadata_bag):
   else:
     outfile = filesafe("%s.mp4" % metadata_bag['title'])
 
+  # The metadata and language tag arguments never change across
+  # retries, so build them once outside the loop.
+  metadata_args = []
+  for k, v in metadata_bag.items():
+    metadata_args.extend(['-metadata', '%s=%s' % (k, str(v))])
+  metadata_args.extend(stream_language_tags(streams))
 
   while True:
     cmd = [ 'ffmpeg',
@@ -223,20 +276,53 @@ def re_mux(tmpfile, metadata_bag):
     # after a recoverable error.
     cmd.append('-y')
     # Now you can do metadata arguments.
-    for k, v in metadata_bag.items():
-      cmd.append('-metadata')
-      cmd.append('%s=%s' % (k, str(v)))
-    cmd.extend(stream_language_tags(streams))
+    cmd.extend(metadata_args)
     # Output file is the only positional argument, and has to go last.
     cmd.append(outfile)
 
     msg('and away we go: %s' % ' '.join(cmd))
-    child = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-    stdout, stderr = child.communicate(input=None)
+    child = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, bufsize=1<<20)
+
+    # stderr is the only pipe, so we can scan it right here as it
+    # streams, instead of letting communicate() buffer the whole
+    # torrent of warnings in memory (hundreds of MB for a big vob).
+    # We keep only a tail for the post-mortem.  The dts error happens
+    # during muxing, long after the stream dump, so we can kill ffmpeg
+    # the moment it appears rather than letting it grind to the end of
+    # the input.  The codec-parameters complaint is different: ffmpeg
+    # prints it *before* the input stream dump, and sometimes on runs
+    # that go on to succeed, so we just take note and only act on it
+    # if ffmpeg exits nonzero.
+    tail = collections.deque(maxlen=4096)
+    error, bad_stream = None, None
+    seen_streams = set()
+    in_input = True
+    for line in io.TextIOWrapper(child.stderr, encoding='utf-8',
+                                 errors='replace'):
+      tail.append(line)
+      # Collect the input stream numbers as they scroll by, so the
+      # codec-error recovery below doesn't have to rescan anything.
+      # The 'Output #0' section renumbers the streams, so stop
+      # collecting when it starts.
+      if in_input:
+        if line.startswith('Output #0'):
+          in_input = False
+        elif 'Stream #0:' in line:
+          m = STREAM_RE.search(line)
+          if m: seen_streams.add(m.group(1))
+      if 'non monotonically increasing dts' in line:
+        error = 'dts'
+        break
+      if (bad_stream is None and
+          'Could not find codec parameters for stream' in line):
+        m = CODEC_ERR_RE.search(line)
+        if m: bad_stream = m.group(1)
+    if error: child.terminate()
     status = child.wait()
 
-    if status == 0:
+    if status == 0 and not error:
       msg('ffmpeg returned ok')
       msg('Deleting input file %s' % tmpfile)
       os.unlink(tmpfile)
@@ -247,20 +333,14 @@ def re_mux(tmpfile, metadata_bag):
     elif status > 0:
       msg('ffmpeg returned error status %d' % status)
 
-    # Look for one of the errors we understand.
-    err_re = re.compile(r'non monotonically increasing dts')
-    if err_re.search(stderr):
-        msg('Subtitles are impossible to represent in mpeg.')
-        msg('Trying again with no subtitles.')
-        map_args = ['-map', '0:v', '-map', '0:a']
-        continue
+    if error == 'dts':
+      msg('Subtitles are impossible to represent in mpeg.')
+      msg('Trying again with no subtitles.')
+      map_args = ['-map', '0:v', '-map', '0:a']
+      continue
 
-    err_re = re.compile(r'Could not find codec parameters for stream (\d+)')
-    m = err_re.search(stderr)
-    if m:
-      bad_stream = m.group(1)
+    if bad_stream is not None:
       msg('Cannot interpret stream %s.' % bad_stream)
-      msg('Trying again with that stream excluded.')
       # now for some fun: constructing a set of -map args that
       # excludes only the bad stream.  To make this even better, the
       # error refers to streams by their position in the *output* mux.
@@ -269,27 +349,30 @@ def re_mux(tmpfile, metadata_bag):
       # already did that expansion, then we have to find and remove
       # the right "-map" entry.
       if len(map_args) == 2:
-        map_args = []
-        stream_re = re.compile(r'Stream #0:(\d+)')
-        for line in stderr.split('\n'):
-          # make sure to stop reading after the end of the 'input' section
-          if line.startswith('Output #0'): break
-          m = stream_re.search(line)
-          if m and m.group(1) != bad_stream:
-            map_args.extend(['-map', '0:%s' % m.group(1)])
+        # Only rebuild if the scan actually saw the stream dump; an
+        # empty -map list would make ffmpeg quietly fall back to
+        # picking one 'best' stream of each type and drop the rest.
+        keep = sorted(seen_streams - set([bad_stream]), key=int)
+        if keep:
+          msg('Trying again with that stream excluded.')
+          map_args = []
+          for s in keep:
+            map_args.extend(['-map', '0:%s' % s])
+          continue
+        msg('Never saw the input stream list, so cannot exclude it.')
       else:
+        msg('Trying again with that stream excluded.')
         assert map_args[int(bad_stream) * 2] == '-map'
         # delete twice at the same position to get the '-map' and the '0:x'
         del map_args[int(bad_stream) * 2]
         del map_args[int(bad_stream) * 2]
-      continue
+        continue
 
     # If we made it here, we don't know why ffmpeg crashed.  Good luck!
     msg('Unrecoverable error in ffmpeg.')
     msg('Leaving input file %s behind.' % tmpfile)
-    msg('Dumping stdout, stderr, and sh command to ffmpeg.*')
-    open('ffmpeg.stdout', 'w').write(stdout)
-    open('ffmpeg.stderr', 'w').write(stderr)
+    msg('Dumping stderr tail and sh command to ffmpeg.*')
+    open('ffmpeg.stderr', 'w').write(''.join(tail))
     open('ffmpeg.sh', 'w').write(' '.join(cmd))
     die('Good luck!')
 
@@ -336,16 +419,25 @@ if __name__ == '__main__':
     die('selected %d tracks to rip, but number of tags is %d'
         % (len(tracks), len(titles)))
 
-  tmp = mktemp()
-    
+  # The remux of each title runs while the next title is dumping:
+  # mplayer is bound by the DVD drive and ffmpeg by cpu and disk, so
+  # they pipeline nicely.  A single worker keeps the remuxes in order,
+  # and waiting out the previous one before queueing another bounds
+  # the temp files on disk to two.
+  remuxer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+  pending = None
   for i, track in enumerate(tracks):
     title, episode = titles[i], episodes[i]
+    tmp = mktemp()
     streams = rip(track, tmp)
     metadata = {'title': title,
                 'description': '/'.join(map(str, streams)) }
     if episode: metadata['episode_id'] = episode
     if ARGS.show: metadata['show'] = ARGS.show
     if ARGS.year: metadata['date'] = ARGS.year
-    re_mux(tmp, metadata)
+    if pending: pending.result()
+    pending = remuxer.submit(re_mux, tmp, metadata, streams)
 
+  if pending: pending.result()
+  remuxer.shutdown()
   msg('See You Space Cowboy')